@@ -1,25 +1,43 @@
 from typing import Optional
-from langchain_openai import AzureChatOpenAI
-from pydantic import BaseModel, Field
+from openai import AsyncAzureOpenAI, APIConnectionError, APIStatusError, BadRequestError, RateLimitError
+from tenacity import before_sleep_log, retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from pydantic import BaseModel, ConfigDict, Field
 from dotenv import load_dotenv
 import asyncio
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
 from telethon import TelegramClient, events
+from telethon.errors import ChannelInvalidError, ChannelPrivateError
+from telethon.tl.types import Channel, InputPeerChannel
+from telethon.utils import get_peer_id
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from google.oauth2.service_account import Credentials
 import os
 from datetime import datetime, timezone
 import ast
+import json
+import textwrap
+import re
+import hashlib
+from collections import deque
+from cache import cache_key, close_cache, get_cached, set_cached
 
 # -------- Configure Logging -------- #
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler("app.log", encoding="utf-8"),  # Log to a file with UTF-8 encoding
-        logging.StreamHandler(),  # Stream logs to console
-    ],
-)
+# Records are handed to a background QueueListener thread so file and console I/O
+# never blocks the asyncio event loop
+log_formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+file_handler = logging.FileHandler("app.log", encoding="utf-8")  # Log to a file with UTF-8 encoding
+file_handler.setFormatter(log_formatter)
+stream_handler = logging.StreamHandler()  # Stream logs to console
+stream_handler.setFormatter(log_formatter)
+log_queue = queue.Queue(-1)
+logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[QueueHandler(log_queue)])
+log_listener = QueueListener(log_queue, file_handler, stream_handler)
+log_listener.start()
+atexit.register(log_listener.stop)  # Flush queued records on exit
+atexit.register(close_cache)
 
 # -------- Load Environment Variables -------- #
 load_dotenv()
@@ -29,38 +47,101 @@ API_ID = os.getenv("TELEGRAM_API_ID")
 API_HASH = os.getenv("TELEGRAM_API_HASH")
 PHONE_NUM = os.getenv("TELEGRAM_PHONE")
 CHANNELS = ["https://t.me/dot_aware", "https://t.me/OceanOfJobs", "https://t.me/jobs_and_internships_updates", "https://t.me/blah1bla"]
-logging.info(f"The taken details are: {PHONE_NUM}, {API_ID}, {API_HASH}, {CHANNELS}")
-logging.info(f"With types: {type(PHONE_NUM)}, {type(API_ID)}, {type(API_HASH)}, {type(CHANNELS)}")
+logging.info("The taken details are: %s, %s, %s, %s", PHONE_NUM, API_ID, API_HASH, CHANNELS)
+logging.info("With types: %s, %s, %s, %s", type(PHONE_NUM), type(API_ID), type(API_HASH), type(CHANNELS))
 
 # Google Sheets Configuration
 GOOGLE_SHEET_NAME = os.getenv("GOOGLE_SHEET_NAME")
-logging.info(f"Google Sheet Name: {GOOGLE_SHEET_NAME}")
-logging.info(f"Type of Google Sheet Name: {type(GOOGLE_SHEET_NAME)}")
+logging.info("Google Sheet Name: %s", GOOGLE_SHEET_NAME)
+logging.info("Type of Google Sheet Name: %s", type(GOOGLE_SHEET_NAME))
 
 # Azure OpenAI API Configuration
 AZURE_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
 AZURE_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION")
 AZURE_API_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
 AZURE_DEPLOYMENT_NAME = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
-logging.info(f"The taken details are: {AZURE_API_ENDPOINT}, {AZURE_API_VERSION}, {AZURE_DEPLOYMENT_NAME}, {AZURE_API_KEY}")
-logging.info(f"With types: {type(AZURE_API_ENDPOINT)}, {type(AZURE_API_VERSION)}, {type(AZURE_DEPLOYMENT_NAME)}, {type(AZURE_API_KEY)}")
+logging.info("The taken details are: %s, %s, %s, %s", AZURE_API_ENDPOINT, AZURE_API_VERSION, AZURE_DEPLOYMENT_NAME, AZURE_API_KEY)
+logging.info("With types: %s, %s, %s, %s", type(AZURE_API_ENDPOINT), type(AZURE_API_VERSION), type(AZURE_DEPLOYMENT_NAME), type(AZURE_API_KEY))
 
 # -------- Initialize Azure OpenAI Client -------- #
-client = AzureChatOpenAI(
-    azure_deployment=AZURE_DEPLOYMENT_NAME,
+# Retries are handled by `create_completion` so the SDK's own retry loop is disabled
+client = AsyncAzureOpenAI(
+    api_key=AZURE_API_KEY,
     api_version=AZURE_API_VERSION,
-    temperature=0,
-    max_tokens=None,
-    timeout=None,
-    max_retries=2,
+    azure_endpoint=AZURE_API_ENDPOINT,
+    max_retries=0,
 )
+LLM_MAX_ATTEMPTS = 4
+
+# Google API scopes needed to open the spreadsheet by name and append rows
+GOOGLE_SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+]
 
 # Collect all `.json` credential files in the current directory
 CREDENTIALS_FILES = ["sheets/sreehari-credentials.json"]  # We will create this file dynamically in GitHub Actions
 
+# Last processed message id per channel, persisted so restarts only fetch new messages.
+# A watermark never moves past a message that is still in flight. Failed messages are
+# kept in a persisted per-channel retry set and fetched again by id on later runs.
+STATE_FILE = "state.json"
+MAX_MESSAGE_ATTEMPTS = 3  # Failed messages are dropped from the retry set after this many attempts
+channel_state: dict[str, int] = {}
+retry_messages: dict[str, dict[str, int]] = {}  # Failed message ids per channel with their attempt counts
+claimed_messages: set[tuple[str, int]] = set()  # Picked up by the backfill or the live listener
+in_flight_messages: dict[str, set[int]] = {}  # Claimed but not yet written to the sheets
+completed_message_ids: dict[str, int] = {}  # Newest message id that finished processing
+backfilling_channels: set[str] = set()  # Watermarks are frozen while a channel's history is fetched
+
+# Resolved channel ids and access hashes, persisted so startup skips username resolution
+ENTITY_CACHE_FILE = "entities.json"
+entity_cache: dict[str, dict] = {}
+listened_channels: set[str] = set()  # Peer ids the live listener accepts, updated when a channel is re-resolved
+
+# `(channel_key, message_id, row)` entries collected during the historical backfill,
+# written in one batch per sheet
+pending_rows: list[tuple] = []
+
+# Seconds to sleep between history requests. Telethon defaults to 1s for unbounded
+# iteration; FloodWait errors are still slept through automatically.
+HISTORY_WAIT_TIME = 0
+
+# `(channel_key, message_id, row)` entries from live messages, written in batches by `flush_live_queue`.
+# Bounded so a rate-limited Sheets API can't grow memory without limit; the oldest rows are dropped when full.
+LIVE_QUEUE_SIZE = 10_000
+live_queue: asyncio.Queue = asyncio.Queue(maxsize=LIVE_QUEUE_SIZE)
+LIVE_BATCH_SIZE = 20
+LIVE_MAX_BATCH_SIZE = 500  # Rows already queued are written together, up to this many per flush
+LIVE_FLUSH_INTERVAL = 3  # Seconds to wait for more rows before writing a partial batch
+
+# Maximum number of concurrent Azure OpenAI requests (keeps us within the deployment's TPM)
+LLM_CONCURRENCY = 32
+llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+# -------- Job Message Pre-filter -------- #
+# Messages without any of these tokens are not sent to the LLM. Inflected forms
+# (internships, openings, recruiting, passouts) and amounts like "8LPA" also match.
+JOB_RE = re.compile(
+    r"\b(hiring|appl(y|ication)\w*|intern\w*|roles?|positions?|openings?|recruit\w*|passouts?"
+    r"|jobs?|batch|vacanc\w*|sde|ctc|lpa|yoe|experience)\b|\d\s*lpa\b",
+    re.IGNORECASE,
+)
+MIN_MESSAGE_LENGTH = 40
+MAX_MESSAGE_LENGTH = 6000  # Long forwarded threads are truncated before extraction
+
+# -------- Near-Duplicate Detection -------- #
+SIMHASH_BITS = 64
+SIMHASH_SHINGLE_SIZE = 3
+SIMHASH_MAX_DISTANCE = 3  # Messages within this Hamming distance are treated as duplicates
+recent_hashes: deque[int] = deque(maxlen=2000)
+extracting_hashes: set[int] = set()  # Fingerprints still being extracted, shared by all channels and the live listener
+
 # -------- Add Structured Output Schema with Pydantic -------- #
 class JobDetails(BaseModel):
     """Schema for structured job details extracted by the model."""
+    model_config = ConfigDict(frozen=True, extra="forbid")  # Strict JSON schema requires additionalProperties: false
+
     company_name: str = Field(description="The name of the company.")
     job_role: str = Field(description="The specific job role or position.")
     ctc: Optional[str] = Field(description="The Cost to Company or salary information (e.g., 10-15 LPA).")
@@ -68,98 +149,580 @@ class JobDetails(BaseModel):
     passout_year: Optional[str] = Field(description="The passout year of the candidate.")
     application_link: Optional[str] = Field(description="The URL or link to apply for the job.")
 
-# Enhance Azure OpenAI client with structured output
-structured_client = client.with_structured_output(JobDetails)
+# Returned when nothing could be extracted from a message
+EMPTY_JOB_DETAILS = JobDetails(
+    company_name="",
+    job_role="",
+    ctc="",
+    years_of_experience="",
+    passout_year="",
+    application_link=""
+)
+
+# The extraction is split into two smaller prompts that run in parallel
+class JobIdentity(BaseModel):
+    """Schema for the fields identifying a job posting."""
+    model_config = ConfigDict(extra="forbid")
+
+    company_name: str = Field(description="The name of the company.")
+    job_role: str = Field(description="The specific job role or position.")
+    application_link: Optional[str] = Field(description="The URL or link to apply for the job.")
+
+class JobConstraints(BaseModel):
+    """Schema for the eligibility and compensation fields of a job posting."""
+    model_config = ConfigDict(extra="forbid")
+
+    ctc: Optional[str] = Field(description="The Cost to Company or salary information (e.g., 10-15 LPA).")
+    years_of_experience: Optional[str] = Field(description="The required years of experience for the job.")
+    passout_year: Optional[str] = Field(description="The passout year of the candidate.")
+
+# -------- Prebuilt Extraction Prompts -------- #
+# Prompts and response formats are built once at import and shared by every request
+def build_response_format(model: type[BaseModel]) -> dict:
+    """Build a strict json_schema response format so the reply is guaranteed to match `model`."""
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": model.__name__, "schema": model.model_json_schema(), "strict": True},
+    }
+
+JOB_IDENTITY_PROMPT = textwrap.dedent("""
+    Extract the following details from the message if it's a job posting:
+    - Company Name
+    - Job Role
+    - Application Link
+    Return the details as a JSON object with exact keys: company_name, job_role, application_link.
+    If any information is missing, leave it as an empty string.
+""").strip()
+JOB_CONSTRAINTS_PROMPT = textwrap.dedent("""
+    Extract the following details from the message if it's a job posting:
+    - CTC (Cost to Company / Salary)
+    - Years of Experience
+    - Passout Year
+    Return the details as a JSON object with exact keys: ctc, years_of_experience, passout_year.
+    If any information is missing, leave it as an empty string.
+""").strip()
+JOB_IDENTITY_RESPONSE_FORMAT = build_response_format(JobIdentity)
+JOB_CONSTRAINTS_RESPONSE_FORMAT = build_response_format(JobConstraints)
+
+# Bump whenever the extraction prompt or schema changes so cached responses are invalidated
+PROMPT_VERSION = "v2"
 
 # -------- Azure OpenAI Function -------- #
-def extract_job_details(message: str) -> JobDetails:
+def is_transient_error(error: BaseException) -> bool:
+    """Only connection errors, timeouts, 429s and 5xx responses are worth retrying."""
+    if isinstance(error, (APIConnectionError, RateLimitError)):
+        return True
+    return isinstance(error, APIStatusError) and (error.status_code == 408 or error.status_code >= 500)
+
+@retry(
+    retry=retry_if_exception(is_transient_error),
+    wait=wait_exponential_jitter(initial=0.5, max=8),
+    stop=stop_after_attempt(LLM_MAX_ATTEMPTS),
+    before_sleep=before_sleep_log(logging.getLogger(), logging.WARNING),
+    reraise=True,
+)
+async def create_completion(prompt: list[dict], response_format: dict):
+    """Send a chat completion request, retrying transient failures with jittered backoff."""
+    async with llm_semaphore:
+        return await client.chat.completions.create(
+            model=AZURE_DEPLOYMENT_NAME,
+            messages=prompt,
+            response_format=response_format,
+            temperature=0,
+        )
+
+async def request_structured_output(system_prompt: str, message: str, model: type[BaseModel], response_format: dict):
     """
-    Extract job details using the structured Azure OpenAI LLM.
+    Send a single structured request to Azure OpenAI and parse the reply into `model`.
+    Returns None if the message was blocked by the content filter.
     """
     prompt = [
-        {
-            "role": "system",
-            "content": """
-            Extract the following details from the message if it's a job posting:
-            - Company Name
-            - Job Role
-            - CTC (Cost to Company / Salary)
-            - Years of Experience
-            - Passout Year
-            - Application Link
-            Return the details as a JSON object with exact keys: company_name, job_role, ctc, years_of_experience, passout_year, application_link.
-            If any information is missing, leave it as an empty string. 
-            """
-        },
-        {"role": "user", "content": message},
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": message[:MAX_MESSAGE_LENGTH]},
     ]
     try:
-        # Send structured request to Azure OpenAI
-        response = structured_client.invoke(prompt)  # Automatically parse into JobDetails structure
-        logging.info(f"Structured Job Details: {response}")
+        completion = await create_completion(prompt, response_format)
+    except BadRequestError as e:
+        if e.code == "content_filter":
+            logging.warning("Message blocked by the Azure OpenAI content filter.")
+            return None
+        raise
+    choice = completion.choices[0]
+    if choice.finish_reason == "content_filter":
+        logging.warning("Response blocked by the Azure OpenAI content filter.")
+        return None
+    return model.model_validate_json(choice.message.content)
+
+async def extract_job_details(message: str) -> Optional[JobDetails]:
+    """
+    Extract job details using the structured Azure OpenAI LLM.
+    Returns None if the request failed, so callers can retry the message later.
+    At most LLM_CONCURRENCY requests are in flight at once across all callers.
+    Responses are cached by message content, so reposted messages skip the LLM call.
+    """
+    key = cache_key(PROMPT_VERSION, message)
+    # SQLite calls run in a worker thread so disk I/O doesn't block the event loop
+    cached = await asyncio.to_thread(get_cached, key)
+    if cached is not None:
+        logging.info("Using cached job details for message.")
+        return JobDetails.model_validate_json(cached)
+
+    try:
+        # Send both structured requests to Azure OpenAI concurrently and merge the results
+        identity, constraints = await asyncio.gather(
+            request_structured_output(JOB_IDENTITY_PROMPT, message, JobIdentity, JOB_IDENTITY_RESPONSE_FORMAT),
+            request_structured_output(JOB_CONSTRAINTS_PROMPT, message, JobConstraints, JOB_CONSTRAINTS_RESPONSE_FORMAT),
+        )
+        if identity is None or constraints is None:
+            # Filtered messages will be filtered again, so cache them as empty results
+            response = EMPTY_JOB_DETAILS
+        else:
+            response = JobDetails(**identity.model_dump(), **constraints.model_dump())
+        logging.info("Structured Job Details: %s", response)
+        await asyncio.to_thread(set_cached, key, response.model_dump_json())
         return response
     except Exception as e:
-        logging.error(f"Error in Azure OpenAI response: {e}")
-        # Return default empty job details in case of errors
-        return JobDetails(
-            company_name="",
-            job_role="",
-            ctc="",
-            application_link=""
-        )
+        logging.error("Error in Azure OpenAI response: %s", e)
+        return None
 
 # -------- Google Sheets Helper Functions -------- #
 def connect_to_google_sheet(credentials_file: str):
-    """Connect to Google Sheets API and return the sheet instance."""
-    scope = [
-        "https://spreadsheets.google.com/feeds",
-        "https://www.googleapis.com/auth/drive",
-    ]
+    """
+    Connect to Google Sheets API and return a `(sheet, title)` tuple.
+    The title is read once here so logging doesn't trigger a metadata request per append.
+    """
     try:
-        creds = ServiceAccountCredentials.from_json_keyfile_name(credentials_file, scope)
+        creds = Credentials.from_service_account_file(credentials_file, scopes=GOOGLE_SCOPES)
         client = gspread.authorize(creds)
         sheet = client.open(GOOGLE_SHEET_NAME).sheet1
-        logging.info(f"Connected to Google Sheets using credentials: {credentials_file}")
-        return sheet
+        title = sheet.title
+        logging.info("Connected to Google Sheets using credentials: %s", credentials_file)
+        return sheet, title
     except Exception as e:
-        logging.error(f"Failed to connect to Google Sheets with {credentials_file}: {e}")
+        logging.error("Failed to connect to Google Sheets with %s: %s", credentials_file, e)
         raise e
 
-def append_to_google_sheets(sheets, data: JobDetails):
-    """Append extracted job details to all provided Google Sheets."""
-    for sheet in sheets:
-        try:
-            sheet.append_row(
-                [
-                    data.company_name,
-                    data.job_role,
-                    data.ctc,
-                    data.years_of_experience,
-                    data.passout_year,
-                    data.application_link,
-                ]
-            )
-            logging.info(f"Appended data to Google Sheet: {sheet.title}")
-        except Exception as e:
-            logging.error(f"Failed to append data to Google Sheet: {sheet.title}: {e}")
+def append_rows_to_sheet(sheet, title: str, rows: list[tuple]) -> bool:
+    """Append rows of extracted job details to a single Google Sheet in one request."""
+    try:
+        sheet.append_rows(
+            rows,
+            value_input_option="USER_ENTERED",
+            insert_data_option="INSERT_ROWS",
+        )
+        logging.info("Appended %s rows to Google Sheet: %s", len(rows), title)
+        return True
+    except Exception as e:
+        logging.error("Failed to append rows to Google Sheet: %s: %s", title, e)
+        return False
+
+async def append_to_google_sheets(sheets, rows: list[tuple]) -> bool:
+    """
+    Append rows of extracted job details to all provided Google Sheets concurrently.
+    Returns True only if every sheet was written.
+    """
+    results = await asyncio.gather(
+        *[asyncio.to_thread(append_rows_to_sheet, sheet, title, rows) for sheet, title in sheets]
+    )
+    return all(results)
+
+async def write_entries(sheets, entries: list[tuple]):
+    """
+    Write the rows of `(channel_key, message_id, row)` entries and settle their
+    messages, so watermarks only advance past rows that reached every sheet.
+    """
+    written = await append_to_google_sheets(sheets, [row for _, _, row in entries])
+    for channel_key, message_id, _ in entries:
+        complete_message(channel_key, message_id, written)
+    save_channel_state()
+
+async def flush_pending_rows(sheets):
+    """Write all buffered backfill rows to every sheet with a single request each."""
+    if not pending_rows:
+        save_channel_state()
+        return
+    await write_entries(sheets, pending_rows)
+    pending_rows.clear()
+
+def queue_live_row(channel_key: str, message_id: int, row: tuple):
+    """Queue a live row for the flusher, dropping the oldest queued row if the queue is full."""
+    if live_queue.full():
+        dropped_key, dropped_id, dropped = live_queue.get_nowait()
+        logging.warning("Live queue is full, dropping oldest row: %s", dropped)
+        complete_message(dropped_key, dropped_id, False)
+    live_queue.put_nowait((channel_key, message_id, row))
+
+async def flush_live_queue(sheets):
+    """
+    Background task that drains `live_queue`, batching rows until
+    LIVE_BATCH_SIZE rows are collected or LIVE_FLUSH_INTERVAL seconds pass.
+    A backlog is drained immediately in batches of up to LIVE_MAX_BATCH_SIZE rows.
+    When cancelled, the rows collected so far and everything still queued are written first.
+    """
+    loop = asyncio.get_running_loop()
+    rows = []
+    writing = None
+    try:
+        while True:
+            rows = [await live_queue.get()]
+            deadline = loop.time() + LIVE_FLUSH_INTERVAL
+            while len(rows) < LIVE_MAX_BATCH_SIZE:
+                if not live_queue.empty():
+                    rows.append(live_queue.get_nowait())
+                    continue
+                if len(rows) >= LIVE_BATCH_SIZE:
+                    break
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    rows.append(await asyncio.wait_for(live_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Shielded so cancellation waits for the write to finish and settle its messages
+            batch, rows = rows, []
+            writing = asyncio.ensure_future(write_entries(sheets, batch))
+            await asyncio.shield(writing)
+            writing = None
+    except asyncio.CancelledError:
+        if writing is not None:
+            await writing
+        while not live_queue.empty():
+            rows.append(live_queue.get_nowait())
+        if rows:
+            logging.info("Writing %s queued rows before shutting down.", len(rows))
+        for start in range(0, len(rows), LIVE_MAX_BATCH_SIZE):
+            await write_entries(sheets, rows[start:start + LIVE_MAX_BATCH_SIZE])
+        raise
+
+# -------- Channel State Helpers -------- #
+def load_channel_state():
+    """Load the watermark and failed messages of each channel from STATE_FILE."""
+    try:
+        with open(STATE_FILE, encoding="utf-8") as f:
+            state = json.load(f)
+        if "watermarks" in state:
+            channel_state.update(state["watermarks"])
+            retry_messages.update(state.get("retries", {}))
+        else:
+            channel_state.update(state)  # Older state files only stored watermarks
+        logging.info("Loaded message watermarks for %s channels.", len(channel_state))
+    except FileNotFoundError:
+        logging.info("No channel state found, fetching today's messages.")
+    except Exception as e:
+        logging.error("Failed to load channel state from %s: %s", STATE_FILE, e)
+
+def save_channel_state():
+    """Persist the watermark and failed messages of each channel to STATE_FILE."""
+    try:
+        with open(STATE_FILE, "w", encoding="utf-8") as f:
+            json.dump({"watermarks": channel_state, "retries": retry_messages}, f)
+    except Exception as e:
+        logging.error("Failed to save channel state to %s: %s", STATE_FILE, e)
+
+def advance_watermark(channel_key: str):
+    """
+    Move a channel's watermark up to its newest completed message, but never past
+    a message that is still in flight. Failed messages don't hold it back; they are
+    retried by id from `retry_messages` instead.
+    """
+    if channel_key in backfilling_channels:
+        return
+    newest = completed_message_ids.get(channel_key, 0)
+    in_flight = in_flight_messages.get(channel_key)
+    if in_flight:
+        newest = min(newest, min(in_flight) - 1)
+    channel_state[channel_key] = max(channel_state.get(channel_key, 0), newest)
+
+def claim_message(channel_key: str, message_id: int) -> bool:
+    """
+    Mark a message as in flight. Returns False if the backfill or the live
+    listener already picked it up, so it isn't processed twice.
+    """
+    if (channel_key, message_id) in claimed_messages:
+        return False
+    claimed_messages.add((channel_key, message_id))
+    in_flight_messages.setdefault(channel_key, set()).add(message_id)
+    return True
+
+def clear_retry(channel_key: str, message_id: int):
+    """Remove a message from its channel's retry set."""
+    retries = retry_messages.get(channel_key)
+    if retries is not None:
+        retries.pop(str(message_id), None)
+        if not retries:
+            del retry_messages[channel_key]
+
+def record_failure(channel_key: str, message_id: int):
+    """Add a failed message to its channel's retry set, giving up after MAX_MESSAGE_ATTEMPTS."""
+    attempts = retry_messages.get(channel_key, {}).get(str(message_id), 0) + 1
+    if attempts >= MAX_MESSAGE_ATTEMPTS:
+        logging.error("Giving up on message %s in %s after %s failed attempts.", message_id, channel_key, attempts)
+        clear_retry(channel_key, message_id)
+    else:
+        retry_messages.setdefault(channel_key, {})[str(message_id)] = attempts
+
+def complete_message(channel_key: str, message_id: int, success: bool):
+    """Record that a claimed message was written (or had nothing to write), or that it failed."""
+    in_flight_messages.get(channel_key, set()).discard(message_id)
+    completed_message_ids[channel_key] = max(completed_message_ids.get(channel_key, 0), message_id)
+    if success:
+        clear_retry(channel_key, message_id)
+    else:
+        record_failure(channel_key, message_id)
+    advance_watermark(channel_key)
+
+# -------- Channel Entity Cache -------- #
+def load_entity_cache():
+    """Load the cached channel ids and access hashes from ENTITY_CACHE_FILE."""
+    try:
+        with open(ENTITY_CACHE_FILE, encoding="utf-8") as f:
+            entity_cache.update(json.load(f))
+        logging.info("Loaded %s cached channel entities.", len(entity_cache))
+    except FileNotFoundError:
+        logging.info("No channel entity cache found, resolving all channels.")
+    except Exception as e:
+        logging.error("Failed to load channel entity cache from %s: %s", ENTITY_CACHE_FILE, e)
+
+def save_entity_cache():
+    """Persist the cached channel ids and access hashes to ENTITY_CACHE_FILE."""
+    try:
+        with open(ENTITY_CACHE_FILE, "w", encoding="utf-8") as f:
+            json.dump(entity_cache, f)
+    except Exception as e:
+        logging.error("Failed to save channel entity cache to %s: %s", ENTITY_CACHE_FILE, e)
+
+async def resolve_channel(client_telegram, channel: str):
+    """
+    Return an `(entity, title)` tuple for a channel link. Cached channels are
+    returned as an InputPeerChannel without contacting Telegram.
+    """
+    cached = entity_cache.get(channel)
+    if cached:
+        return InputPeerChannel(cached["id"], cached["hash"]), cached["title"]
+    entity = await client_telegram.get_entity(channel)
+    if isinstance(entity, Channel):
+        entity_cache[channel] = {"id": entity.id, "hash": entity.access_hash, "title": entity.title}
+        save_entity_cache()
+    return entity, entity.title
+
+async def refresh_channel(client_telegram, channel: str):
+    """Drop a stale cache entry and resolve the channel again over MTProto, re-caching the result."""
+    entity_cache.pop(channel, None)
+    save_entity_cache()
+    entity, title = await resolve_channel(client_telegram, channel)
+    listened_channels.add(str(get_peer_id(entity)))
+    logging.info("Re-resolved channel: %s", title)
+    return entity, title
 
 # -------- Message Processing -------- #
-def process_message(message_text: str, sheets):
-    """Process the message: extract details and append them to Google Sheets."""
-    logging.info(f"Processing message: {message_text}")
-    job_details = extract_job_details(message_text)
-    if any([job_details.company_name, job_details.job_role, job_details.ctc, job_details.application_link]):
-        logging.info(f"Extracted job details: {job_details}")
-        append_to_google_sheets(sheets, job_details)
+def is_job_candidate(message_text: str) -> bool:
+    """Cheap check for whether a message could be a job posting before calling the LLM."""
+    return len(message_text) >= MIN_MESSAGE_LENGTH and JOB_RE.search(message_text) is not None
+
+def simhash(message_text: str) -> int:
+    """Compute a 64-bit SimHash over word shingles of the message."""
+    words = re.findall(r"\w+", message_text.lower())
+    shingles = [
+        " ".join(words[i:i + SIMHASH_SHINGLE_SIZE])
+        for i in range(max(1, len(words) - SIMHASH_SHINGLE_SIZE + 1))
+    ]
+    weights = [0] * SIMHASH_BITS
+    for shingle in shingles:
+        h = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit in range(SIMHASH_BITS) if weights[bit] > 0)
+
+def is_near_duplicate(fingerprint: int, fingerprints) -> bool:
+    """Check whether a fingerprint is within SIMHASH_MAX_DISTANCE of any of `fingerprints`."""
+    return any((fingerprint ^ seen).bit_count() <= SIMHASH_MAX_DISTANCE for seen in fingerprints)
+
+def reserve_fingerprint(message_text: str) -> Optional[int]:
+    """
+    Fingerprint a message and reserve it for extraction. Returns None if it is a
+    near-duplicate of a recently extracted message or of one still being extracted.
+    """
+    fingerprint = simhash(message_text)
+    if is_near_duplicate(fingerprint, recent_hashes) or is_near_duplicate(fingerprint, extracting_hashes):
+        return None
+    extracting_hashes.add(fingerprint)
+    return fingerprint
+
+def release_fingerprint(fingerprint: int, success: bool):
+    """
+    Finish a reservation. Only successful extractions are remembered in `recent_hashes`,
+    so reposts of a message whose extraction failed are still processed.
+    """
+    extracting_hashes.discard(fingerprint)
+    if success:
+        recent_hashes.append(fingerprint)
+
+def is_link_only(job_details: JobDetails) -> bool:
+    """Check whether an application link is the only identifying detail that was extracted."""
+    return bool(job_details.application_link) and not job_details.company_name and not job_details.job_role
+
+def has_job_details(job_details: JobDetails) -> bool:
+    """
+    Check whether the extracted details describe a job posting.
+    Requires both company and role so half-empty rows don't reach the sheets,
+    except for postings where only an application link could be extracted.
+    """
+    return bool(job_details.company_name and job_details.job_role) or is_link_only(job_details)
+
+def job_to_row(job_details: JobDetails) -> tuple:
+    """
+    Convert extracted job details into a Google Sheets row.
+    Rows are buffered as plain tuples, which are much smaller than model instances.
+    """
+    return (
+        job_details.company_name,
+        job_details.job_role,
+        job_details.ctc or "",
+        job_details.years_of_experience or "",
+        job_details.passout_year or "",
+        job_details.application_link or "",
+    )
+
+async def process_message(message_text: str, channel_key: str, message_id: int):
+    """Process the message: extract details and queue them for the Google Sheets flusher."""
+    logging.info("Processing message: %s", message_text)
+    if not is_job_candidate(message_text):
+        logging.info("Skipping message without job indicators.")
+        complete_message(channel_key, message_id, True)
+        return
+    fingerprint = reserve_fingerprint(message_text)
+    if fingerprint is None:
+        logging.info("Skipping near-duplicate of a recent message.")
+        complete_message(channel_key, message_id, True)
+        return
+    job_details = await extract_job_details(message_text)
+    release_fingerprint(fingerprint, job_details is not None)
+    if job_details is None:
+        complete_message(channel_key, message_id, False)
+        return
+    if has_job_details(job_details):
+        if is_link_only(job_details):
+            logging.info("Keeping job posting with only an application link: %s", job_details.application_link)
+        logging.info("Extracted job details: %s", job_details)
+        queue_live_row(channel_key, message_id, job_to_row(job_details))
     else:
         logging.info("No job details found in message.")
+        complete_message(channel_key, message_id, True)
+
+async def process_backfill(channel_key: str, messages: list[tuple[int, str]]):
+    """
+    Extract job details from all backfilled `(message_id, text)` messages of a channel
+    concurrently and buffer the resulting rows in `pending_rows`, preserving message order.
+    Messages without a row are settled immediately; the rest settle when `pending_rows` is written.
+    """
+    candidates = []
+    for message_id, message_text in messages:
+        if is_job_candidate(message_text):
+            candidates.append((message_id, message_text))
+        else:
+            complete_message(channel_key, message_id, True)
+    logging.info("Skipped %s messages without job indicators.", len(messages) - len(candidates))
+
+    # Drop near-duplicates of messages already extracted or being extracted in any channel,
+    # including earlier messages in this batch. If the original fails, it is retried on a later run.
+    unique_messages, fingerprints = [], []
+    for message_id, message_text in candidates:
+        fingerprint = reserve_fingerprint(message_text)
+        if fingerprint is None:
+            complete_message(channel_key, message_id, True)
+        else:
+            unique_messages.append((message_id, message_text))
+            fingerprints.append(fingerprint)
+    logging.info("Skipped %s near-duplicate messages.", len(candidates) - len(unique_messages))
+
+    # Concurrency is bounded by `llm_semaphore` inside `extract_job_details`
+    results = await asyncio.gather(*[extract_job_details(message_text) for _, message_text in unique_messages])
+    extracted = 0
+    for (message_id, _), fingerprint, job_details in zip(unique_messages, fingerprints, results):
+        release_fingerprint(fingerprint, job_details is not None)
+        if job_details is None:
+            complete_message(channel_key, message_id, False)
+            continue
+        if has_job_details(job_details):
+            if is_link_only(job_details):
+                logging.info("Keeping job posting with only an application link: %s", job_details.application_link)
+            row = job_to_row(job_details)
+            logging.info("Extracted job details: %s", row)
+            pending_rows.append((channel_key, message_id, row))
+            extracted += 1
+        else:
+            complete_message(channel_key, message_id, True)
+    logging.info("Extracted %s job postings from %s messages.", extracted, len(unique_messages))
+
+async def backfill_channel(client_telegram, channel: str, entity, title: str, start_of_day: datetime):
+    """
+    Fetch messages newer than the channel's watermark (or today's messages on the
+    first run) and extract job details from them into `pending_rows`.
+    If a cached entity turns out to be stale, the channel is re-resolved and fetched again.
+    """
+    channel_key = str(get_peer_id(entity))
+    last_id = channel_state.get(channel_key, 0)
+    messages = []
+    stale = False
+
+    def collect(msg):
+        if not claim_message(channel_key, msg.id):
+            return
+        if msg.message:
+            messages.append((msg.id, msg.message))
+        else:
+            complete_message(channel_key, msg.id, True)
+
+    backfilling_channels.add(channel_key)
+    try:
+        # Messages that failed on earlier runs are fetched again by id
+        retry_ids = sorted(int(message_id) for message_id in retry_messages.get(channel_key, {}))
+        if retry_ids:
+            logging.info("Retrying %s failed messages from %s", len(retry_ids), title)
+            for message_id, msg in zip(retry_ids, await client_telegram.get_messages(entity, ids=retry_ids)):
+                if msg is None:
+                    clear_retry(channel_key, message_id)  # Deleted since it failed
+                else:
+                    collect(msg)
+        async for msg in client_telegram.iter_messages(
+            entity,
+            min_id=last_id,
+            offset_date=None if last_id else start_of_day,
+            reverse=True,
+            limit=None,
+            wait_time=HISTORY_WAIT_TIME,
+        ):
+            collect(msg)
+    except (ChannelInvalidError, ChannelPrivateError) as e:
+        logging.error("Error fetching messages from %s: %s", title, e)
+        stale = isinstance(entity, InputPeerChannel)
+    except Exception as e:
+        logging.error("Error fetching messages from %s: %s", title, e)
+    finally:
+        backfilling_channels.discard(channel_key)
+        advance_watermark(channel_key)
+
+    logging.info("Fetched %s messages from %s", len(messages), title)
+    await process_backfill(channel_key, messages)
+
+    if stale:
+        try:
+            entity, title = await refresh_channel(client_telegram, channel)
+        except Exception as e:
+            logging.error("Failed to get entity for %s: %s", channel, e)
+            return
+        await backfill_channel(client_telegram, channel, entity, title, start_of_day)
 
 # -------- Telegram Event Handlers -------- #
-async def handle_new_message(event, sheets):
+async def handle_new_message(event):
     """Handle new message event and process the message."""
+    channel_key = str(event.chat_id)
+    if not claim_message(channel_key, event.id):
+        return
     message_text = event.raw_text
-    logging.info(f"New message received: {message_text}")
-    process_message(message_text, sheets)
+    logging.info("New message received: %s", message_text)
+    await process_message(message_text, channel_key, event.id)
 
 # -------- Telegram Bot Workflow -------- #
 async def main():
@@ -183,48 +746,60 @@ async def main():
             sheet = connect_to_google_sheet(credentials_file)
             sheets.append(sheet)
         except Exception as e:
-            logging.error(f"Skipping Google Sheet for {credentials_file} due to errors.")
+            logging.error("Skipping Google Sheet for %s due to errors.", credentials_file)
 
     if not sheets:
         logging.error("No Google Sheets available. Exiting.")
         return
-    logging.info(f"Connected to {len(sheets)} Google Sheets.")
+    logging.info("Connected to %s Google Sheets.", len(sheets))
 
     # Get current day boundaries
     now = datetime.now(timezone.utc)  # Updated code
     start_of_day = datetime(now.year, now.month, now.day)
-    logging.info(f"Fetching messages delivered since: {start_of_day}")
+    logging.info("Fetching messages delivered since: %s", start_of_day)
 
-    # Get channel entities
+    # Get channel entities, using cached ids and access hashes where available
+    load_entity_cache()
     channel_entities = []
     for channel in CHANNELS:
         try:
-            entity = await client_telegram.get_entity(channel.strip())
-            channel_entities.append(entity)
-            logging.info(f"Added channel: {entity.title}")
-        except Exception as e:
-            logging.error(f"Failed to get entity for {channel}: {e}")
-
-    # Fetch and process today's messages
-    for entity in channel_entities:
-        try:
-            async for msg in client_telegram.iter_messages(
-                entity,
-                offset_date=start_of_day,
-                reverse=True,
-            ):
-                if msg.message:
-                    process_message(msg.message, sheets)
+            entity, title = await resolve_channel(client_telegram, channel.strip())
+            channel_entities.append((channel.strip(), entity, title))
+            listened_channels.add(str(get_peer_id(entity)))
+            logging.info("Added channel: %s", title)
         except Exception as e:
-            logging.error(f"Error fetching messages from {entity.title}: {e}")
+            logging.error("Failed to get entity for %s: %s", channel, e)
 
-    # Listen for new messages
-    @client_telegram.on(events.NewMessage(chats=channel_entities))
+    # Listen for new messages before the backfill so nothing posted in between is missed;
+    # messages seen by both are only processed once. Chats are matched against
+    # `listened_channels` so channels re-resolved during the backfill are picked up.
+    @client_telegram.on(events.NewMessage(func=lambda event: str(event.chat_id) in listened_channels))
     async def new_message_listener(event):
-        await handle_new_message(event, sheets)
+        await handle_new_message(event)
+
+    # Fetch new messages from all channels in parallel and extract their job details
+    load_channel_state()
+    await asyncio.gather(
+        *[
+            backfill_channel(client_telegram, channel, entity, title, start_of_day)
+            for channel, entity, title in channel_entities
+        ]
+    )
+
+    # Write the backfilled rows in one request per sheet, then record the new watermarks
+    await flush_pending_rows(sheets)
+
+    # Write rows from live messages in batches in the background
+    flusher = asyncio.create_task(flush_live_queue(sheets))
 
     logging.info("Listening for new messages...")
-    await client_telegram.run_until_disconnected()
+    try:
+        await client_telegram.run_until_disconnected()
+    finally:
+        # Let the flusher write whatever is still queued before exiting
+        flusher.cancel()
+        await asyncio.gather(flusher, return_exceptions=True)
+        save_channel_state()
 
 # -------- Run the Program -------- #
 if __name__ == "__main__":
@@ -235,4 +810,4 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         logging.info("Program terminated by user.")
     except Exception as e:
-        logging.error(f"Unexpected error: {e}")
+        logging.error("Unexpected error: %s", e)
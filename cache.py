@@ -0,0 +1,70 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+# -------- LLM Response Cache -------- #
+CACHE_FILE = "llm_cache.sqlite"
+CACHE_TTL_SECONDS = 7 * 24 * 60 * 60  # Entries older than 7 days are ignored
+
+# A single connection is opened on first use and shared by every worker thread;
+# the lock serializes access since sqlite3 connections aren't safe for concurrent use
+_conn: Optional[sqlite3.Connection] = None
+_lock = threading.Lock()
+
+
+def _connection() -> sqlite3.Connection:
+    """Return the shared cache connection, creating the database and table on first use."""
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(CACHE_FILE, timeout=30, check_same_thread=False)
+        _conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "hash TEXT PRIMARY KEY, json TEXT NOT NULL, created_at INTEGER NOT NULL)"
+        )
+        _conn.commit()
+    return _conn
+
+
+def cache_key(prompt_version: str, message: str) -> str:
+    """Content-addressed key for a message under a given prompt version."""
+    return hashlib.sha256(f"{prompt_version}|{message}".encode("utf-8")).hexdigest()
+
+
+def get_cached(key: str) -> Optional[str]:
+    """Return the cached JSON response for `key`, or None on a miss or expired entry."""
+    try:
+        with _lock:
+            row = _connection().execute(
+                "SELECT json FROM responses WHERE hash = ? AND created_at >= ?",
+                (key, int(time.time()) - CACHE_TTL_SECONDS),
+            ).fetchone()
+        return row[0] if row else None
+    except sqlite3.Error as e:
+        logging.error("Failed to read LLM cache: %s", e)
+        return None
+
+
+def set_cached(key: str, json_value: str):
+    """Store the JSON response for `key`."""
+    try:
+        with _lock:
+            conn = _connection()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (hash, json, created_at) VALUES (?, ?, ?)",
+                    (key, json_value, int(time.time())),
+                )
+    except sqlite3.Error as e:
+        logging.error("Failed to write LLM cache: %s", e)
+
+
+def close_cache():
+    """Close the shared cache connection."""
+    global _conn
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None